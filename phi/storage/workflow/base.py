@@ -27,6 +27,10 @@ class WorkflowStorage(ABC):
     def upsert(self, session: WorkflowSession) -> Optional[WorkflowSession]:
         raise NotImplementedError
 
+    def supports_background_writes(self) -> bool:
+        """Return True if upsert() can be called from a background thread and write to the same database"""
+        return True
+
     @abstractmethod
     def delete_session(self, session_id: Optional[str] = None):
         raise NotImplementedError
@@ -7,6 +7,7 @@ try:
     from sqlalchemy.engine import create_engine, Engine
     from sqlalchemy.inspection import inspect
     from sqlalchemy.orm import Session, sessionmaker
+    from sqlalchemy.pool import SingletonThreadPool
     from sqlalchemy.schema import MetaData, Table, Column
     from sqlalchemy.sql.expression import select
     from sqlalchemy.types import String
@@ -283,6 +284,16 @@ class SqlWorkflowStorage(WorkflowStorage):
             return None
         return self.read(session_id=session.session_id)
 
+    def supports_background_writes(self) -> bool:
+        """
+        Check if upsert() can be called from a background thread.
+        In-memory sqlite databases use one connection, and so one database, per thread.
+
+        Returns:
+            bool: False for in-memory databases, True otherwise.
+        """
+        return not isinstance(self.db_engine.pool, SingletonThreadPool)
+
     def delete_session(self, session_id: Optional[str] = None):
         """
         Delete a workflow session from the database.
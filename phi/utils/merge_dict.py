@@ -13,8 +13,11 @@ def merge_dictionaries(a: Dict[str, Any], b: Dict[str, Any]) -> None:
     Returns:
         None: The function modifies the first dictionary in place.
     """
-    for key in b:
-        if key in a and isinstance(a[key], dict) and isinstance(b[key], dict):
-            merge_dictionaries(a[key], b[key])
-        else:
-            a[key] = b[key]
+    for key, b_value in b.items():
+        # Only nested dictionaries need to be merged, all other values are assigned
+        if isinstance(b_value, dict):
+            a_value = a.get(key)
+            if isinstance(a_value, dict):
+                merge_dictionaries(a_value, b_value)
+                continue
+        a[key] = b_value
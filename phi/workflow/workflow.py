@@ -1,12 +1,14 @@
 import collections.abc
+import functools
 import inspect
 
+from concurrent.futures import Future, ThreadPoolExecutor
 from os import getenv
 from uuid import uuid4
 from types import GeneratorType
-from typing import Any, Optional, Callable, Dict
+from typing import Any, Optional, Callable, ClassVar, Dict, Iterable, Iterator, List, Tuple, get_origin
 
-from pydantic import BaseModel, Field, ConfigDict, field_validator, PrivateAttr
+from pydantic import BaseModel, Field, ConfigDict, field_validator
 
 from phi.agent import Agent
 from phi.run.response import RunResponse, RunEvent  # noqa: F401
@@ -16,6 +18,81 @@ from phi.utils.log import logger, set_log_level_to_debug, set_log_level_to_info
 from phi.utils.merge_dict import merge_dictionaries
 from phi.workflow.session import WorkflowSession
 
+# Sentinels for parameters and return values without annotations or defaults
+_PARAM_EMPTY = inspect.Parameter.empty
+_SIG_EMPTY = inspect.Signature.empty
+# Return types of run methods that stream their responses
+_STREAM_RETURN_TYPES = (collections.abc.Iterator, collections.abc.Generator, collections.abc.Iterable)
+# Executor used for background writes to storage
+_storage_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="phi-workflow-storage")
+
+
+def _format_annotation(annotation: Any) -> Optional[str]:
+    """Get a serializable name for the annotation of a run method parameter"""
+
+    if annotation is _PARAM_EMPTY:
+        return None
+    if hasattr(annotation, "__name__"):
+        return annotation.__name__
+    annotation_str = str(annotation)
+    # Unwrap Optional[...] annotations
+    if annotation_str.startswith("typing.Optional["):
+        return annotation_str[len("typing.Optional[") : -1]
+    return annotation_str
+
+
+def _wrap_run(run: Callable) -> Callable:
+    """Wrap the run method of a Workflow subclass so that calling it starts a workflow run.
+
+    Calling self.run() always starts a new workflow run, including from inside a running run method.
+    Only super().run() calls made during a run, which reach the wrapper of a parent class, call the
+    original run method of that class directly.
+    """
+
+    @functools.wraps(run)
+    def wrapped_run(self: "Workflow", *args: Any, **kwargs: Any):
+        # super().run() during a run reaches a run method other than the one this workflow runs
+        if self._run_in_progress and run is not self.__class__._subclass_run:
+            return run(self, *args, **kwargs)
+        return self.run_workflow(*args, **kwargs)
+
+    setattr(wrapped_run, "_is_wrapped_run", True)
+    return wrapped_run
+
+
+def _introspect_run(run: Callable) -> Tuple[Dict[str, Any], Optional[str], Optional[str]]:
+    """Get the parameters, return type and run mode of a Workflow run method"""
+
+    # Get the parameters of the run method
+    sig = inspect.signature(run)
+    # Convert parameters to a serializable format
+    run_parameters = {
+        name: {
+            "name": name,
+            "default": param.default if param.default is not _PARAM_EMPTY else None,
+            "annotation": _format_annotation(param.annotation),
+            "required": param.default is _PARAM_EMPTY,
+        }
+        for name, param in sig.parameters.items()
+        if name != "self"
+    }
+    # Determine the return type of the run method
+    return_annotation = sig.return_annotation
+    run_return_type = (
+        return_annotation.__name__
+        if return_annotation is not _SIG_EMPTY and hasattr(return_annotation, "__name__")
+        else str(return_annotation)
+        if return_annotation is not _SIG_EMPTY
+        else None
+    )
+    # Determine if the run method streams its responses
+    run_mode = None
+    if return_annotation is RunResponse:
+        run_mode = "single"
+    elif get_origin(return_annotation) in _STREAM_RETURN_TYPES:
+        run_mode = "stream"
+    return run_parameters, run_return_type, run_mode
+
 
 class Workflow(BaseModel):
     # -*- Workflow settings
@@ -43,12 +120,21 @@ class Workflow(BaseModel):
     session_state: Dict[str, Any] = Field(default_factory=dict)
 
     # -*- Workflow Memory
-    memory: WorkflowMemory = WorkflowMemory()
+    memory: WorkflowMemory = Field(default_factory=WorkflowMemory)
 
     # -*- Workflow Storage
     storage: Optional[WorkflowStorage] = None
     # WorkflowSession from the database: DO NOT SET MANUALLY
     _workflow_session: Optional[WorkflowSession] = None
+    # True if the session was changed in storage and must be read again before the next run: DO NOT SET MANUALLY
+    _session_dirty: bool = False
+    # Write runs to storage in a background thread instead of blocking the run
+    # Call flush() to wait for pending writes
+    background_storage_writes: bool = False
+    # Pending background write to storage: DO NOT SET MANUALLY
+    _pending_write: Optional[Future] = None
+    # True while the run method of the subclass is executing: DO NOT SET MANUALLY
+    _run_in_progress: bool = False
 
     # debug_mode=True enables debug logs
     debug_mode: bool = Field(False, validate_default=True)
@@ -68,25 +154,25 @@ class Workflow(BaseModel):
     # Metadata associated with this session: DO NOT SET MANUALLY
     session_data: Optional[Dict[str, Any]] = None
 
-    # The run function provided by the subclass
-    _subclass_run: Callable = PrivateAttr()
     # Parameters of the run function
-    _run_parameters: Dict[str, Any] = PrivateAttr()
+    _run_parameters: ClassVar[Dict[str, Any]] = {}
     # Return type of the run function
-    _run_return_type: Optional[str] = PrivateAttr()
+    _run_return_type: ClassVar[Optional[str]] = None
+    # "stream" if the run function returns an Iterator[RunResponse], "single" if it returns a RunResponse
+    _run_mode: ClassVar[Optional[str]] = None
 
     model_config = ConfigDict(arbitrary_types_allowed=True, populate_by_name=True)
 
     @field_validator("workflow_id", mode="before")
     def set_workflow_id(cls, v: Optional[str]) -> str:
         workflow_id = v or str(uuid4())
-        logger.debug(f"*********** Worfklow ID: {workflow_id} ***********")
+        logger.debug("*********** Worfklow ID: %s ***********", workflow_id)
         return workflow_id
 
     @field_validator("session_id", mode="before")
     def set_session_id(cls, v: Optional[str]) -> str:
         session_id = v or str(uuid4())
-        logger.debug(f"*********** Worflow Session ID: {session_id} ***********")
+        logger.debug("*********** Worflow Session ID: %s ***********", session_id)
         return session_id
 
     @field_validator("debug_mode", mode="before")
@@ -113,7 +199,11 @@ class Workflow(BaseModel):
         return session_data
 
     def get_workflow_session(self) -> WorkflowSession:
-        """Get a WorkflowSession object, which can be saved to the database"""
+        """Get a WorkflowSession object, which can be saved to the database.
+
+        The top-level data dicts are copied, but nested values like session_data["session_state"]
+        are shared with this workflow. Deep copy the session before using it from another thread.
+        """
 
         return WorkflowSession(
             session_id=self.session_id,
@@ -143,7 +233,7 @@ class Workflow(BaseModel):
                 self.name = session.workflow_data.get("name")
 
             # If workflow_data is set in the workflow, update the database workflow_data with the workflow's workflow_data
-            if self.workflow_data is not None:
+            if self.workflow_data:
                 # Updates workflow_session.workflow_data in place
                 merge_dictionaries(session.workflow_data, self.workflow_data)
             self.workflow_data = session.workflow_data
@@ -151,7 +241,7 @@ class Workflow(BaseModel):
         # Read user_data from the database
         if session.user_data is not None:
             # If user_data is set in the workflow, update the database user_data with the workflow's user_data
-            if self.user_data is not None:
+            if self.user_data:
                 # Updates workflow_session.user_data in place
                 merge_dictionaries(session.user_data, self.user_data)
             self.user_data = session.user_data
@@ -178,7 +268,7 @@ class Workflow(BaseModel):
                     self.session_state = session_state_from_db
 
             # If session_data is set in the workflow, update the database session_data with the workflow's session_data
-            if self.session_data is not None:
+            if self.session_data:
                 # Updates workflow_session.session_data in place
                 merge_dictionaries(session.session_data, self.session_data)
             self.session_data = session.session_data
@@ -187,10 +277,11 @@ class Workflow(BaseModel):
         if session.memory is not None:
             try:
                 if "runs" in session.memory:
-                    self.memory.runs = [WorkflowRun(**m) for m in session.memory["runs"]]
+                    # Validate all runs in a single pass instead of constructing each WorkflowRun separately
+                    self.memory.runs = WorkflowMemory.model_validate({"runs": session.memory["runs"]}).runs
             except Exception as e:
-                logger.warning(f"Failed to load WorkflowMemory: {e}")
-        logger.debug(f"-*- WorkflowSession loaded: {session.session_id}")
+                logger.warning("Failed to load WorkflowMemory: %s", e)
+        logger.debug("-*- WorkflowSession loaded: %s", session.session_id)
 
     def read_from_storage(self) -> Optional[WorkflowSession]:
         """Load the WorkflowSession from storage.
@@ -198,22 +289,63 @@ class Workflow(BaseModel):
         Returns:
             Optional[WorkflowSession]: The loaded WorkflowSession or None if not found.
         """
+        # Wait for pending writes so the latest session is read
+        self.flush()
         if self.storage is not None and self.session_id is not None:
             self._workflow_session = self.storage.read(session_id=self.session_id)
+            self._session_dirty = False
             if self._workflow_session is not None:
                 self.from_workflow_session(session=self._workflow_session)
         return self._workflow_session
 
+    def mark_session_dirty(self) -> None:
+        """Read the session from storage again at the start of the next run.
+        Use this when the session was changed in storage outside of this workflow.
+        """
+        self._session_dirty = True
+
     def write_to_storage(self) -> Optional[WorkflowSession]:
         """Save the WorkflowSession to storage
 
         Returns:
             Optional[WorkflowSession]: The saved WorkflowSession or None if not saved.
         """
+        # Wait for pending writes so they are not applied after this one
+        self.flush()
         if self.storage is not None:
             self._workflow_session = self.storage.upsert(session=self.get_workflow_session())
         return self._workflow_session
 
+    def write_run_to_storage(self) -> None:
+        """Save the WorkflowSession to storage after a run.
+        If background_storage_writes is enabled, the write happens in a background thread.
+        """
+        if not self.background_storage_writes or self.storage is None:
+            self.write_to_storage()
+            return
+        if not self.storage.supports_background_writes():
+            logger.debug("%s does not support background writes, writing to storage", self.storage.__class__.__name__)
+            self.write_to_storage()
+            return
+
+        # Wait for the previous write so the writes for this workflow are applied in order
+        self.flush()
+        # The WorkflowSession shares session_state and the other data dicts with this workflow,
+        # so copy it to avoid changes made after the run racing with the write
+        session = self.get_workflow_session().model_copy(deep=True)
+        self._pending_write = _storage_executor.submit(self.storage.upsert, session=session)
+
+    def flush(self) -> Optional[WorkflowSession]:
+        """Wait for the pending background write to storage to complete.
+
+        Returns:
+            Optional[WorkflowSession]: The saved WorkflowSession or None if not saved.
+        """
+        if self._pending_write is not None:
+            pending_write, self._pending_write = self._pending_write, None
+            self._workflow_session = pending_write.result()
+        return self._workflow_session
+
     def load_session(self, force: bool = False) -> Optional[str]:
         """Load an existing session from the database and return the session_id.
         If a session does not exist, create a new session.
@@ -230,7 +362,7 @@ class Workflow(BaseModel):
         # Load an existing session or create a new session
         if self.storage is not None:
             # Load existing session if session_id is provided
-            logger.debug(f"Reading WorkflowSession: {self.session_id}")
+            logger.debug("Reading WorkflowSession: %s", self.session_id)
             self.read_from_storage()
 
             # Create a new session if it does not exist
@@ -241,119 +373,134 @@ class Workflow(BaseModel):
                 self.write_to_storage()
                 if self._workflow_session is None:
                     raise Exception("Failed to create new WorkflowSession in storage")
-                logger.debug(f"-*- Created WorkflowSession: {self._workflow_session.session_id}")
+                logger.debug("-*- Created WorkflowSession: %s", self._workflow_session.session_id)
                 self.log_workflow_session()
         return self.session_id
 
     def run(self, *args: Any, **kwargs: Any):
-        logger.error(f"{self.__class__.__name__}.run() method not implemented.")
+        logger.error("%s.run() method not implemented.", self.__class__.__name__)
         return
 
+    # The run function provided by the subclass
+    # Workflow.run will log an error when called
+    _subclass_run: ClassVar[Callable] = run
+
     def run_workflow(self, *args: Any, **kwargs: Any):
+        # Wait for the previous run to be written to storage before changing any state,
+        # so a failed write leaves the workflow as it was after the previous run
+        self.flush()
         self.run_id = str(uuid4())
         self.run_input = {"args": args, "kwargs": kwargs}
         self.run_response = RunResponse(run_id=self.run_id, session_id=self.session_id, workflow_id=self.workflow_id)
-        self.read_from_storage()
+        # Read the session from storage unless it is already loaded for this session_id and has not changed
+        if (
+            self._session_dirty
+            or self._workflow_session is None
+            or self._workflow_session.session_id != self.session_id
+        ):
+            self.read_from_storage()
 
-        logger.debug(f"*********** Workflow Run Start: {self.run_id} ***********")
-        result = self._subclass_run(*args, **kwargs)
+        logger.debug("*********** Workflow Run Start: %s ***********", self.run_id)
+        # Restore the previous value so a nested run does not end the outer run
+        run_in_progress = self._run_in_progress
+        self._run_in_progress = True
+        try:
+            result = self._subclass_run(*args, **kwargs)
+        finally:
+            self._run_in_progress = run_in_progress
 
         # The run_workflow() method handles both Iterator[RunResponse] and RunResponse
-
-        # Case 1: The run method returns an Iterator[RunResponse]
-        if isinstance(result, (GeneratorType, collections.abc.Iterator)):
-            # Initialize the run_response content
-            self.run_response.content = ""
-
-            def result_generator():
-                for item in result:
-                    if isinstance(item, RunResponse):
-                        # Update the run_id, session_id and workflow_id of the RunResponse
-                        item.run_id = self.run_id
-                        item.session_id = self.session_id
-                        item.workflow_id = self.workflow_id
-
-                        # Update the run_response with the content from the result
-                        if item.content is not None and isinstance(item.content, str):
-                            self.run_response.content += item.content
-                    else:
-                        logger.warning(f"Workflow.run() should only yield RunResponse objects, got: {type(item)}")
-                    yield item
-
-                # Add the run to the memory
-                self.memory.add_run(WorkflowRun(input=self.run_input, response=self.run_response))
-                # Write this run to the database
-                self.write_to_storage()
-                logger.debug(f"*********** Workflow Run End: {self.run_id} ***********")
-
-            return result_generator()
-        # Case 2: The run method returns a RunResponse
-        elif isinstance(result, RunResponse):
-            # Update the result with the run_id, session_id and workflow_id of the workflow run
-            result.run_id = self.run_id
-            result.session_id = self.session_id
-            result.workflow_id = self.workflow_id
-
-            # Update the run_response with the content from the result
-            if result.content is not None and isinstance(result.content, str):
-                self.run_response.content = result.content
-
-            # Add the run to the memory
-            self.memory.add_run(WorkflowRun(input=self.run_input, response=self.run_response))
-            # Write this run to the database
-            self.write_to_storage()
-            logger.debug(f"*********** Workflow Run End: {self.run_id} ***********")
-            return result
+        # If the run method is annotated to return a RunResponse, skip the iterator checks below.
+        # Annotations are not enforced, so anything else falls through to the checks below.
+        if self._run_mode == "single" and isinstance(result, RunResponse):
+            return self._handle_single(result)
+
+        # Case 1: The run method returns a RunResponse
+        if isinstance(result, RunResponse):
+            return self._handle_single(result)
+        # Case 2: The run method returns an Iterator[RunResponse]
+        # Check the type, so the lookup does not go through the __getattr__ of the result
+        result_type = type(result)
+        if isinstance(result, GeneratorType) or (hasattr(result_type, "__next__") and hasattr(result_type, "__iter__")):
+            return self._handle_stream(result)
         else:
-            logger.warning(f"Workflow.run() should only return RunResponse objects, got: {type(result)}")
+            logger.warning("Workflow.run() should only return RunResponse objects, got: %s", type(result))
             return None
 
+    def _handle_stream(self, result: Iterable[RunResponse]) -> Iterator[RunResponse]:
+        """Yield the RunResponse objects from the run method and save the run once they are exhausted"""
+
+        # Collect the content chunks and join them once the run completes
+        content_chunks: List[str] = []
+        iterator = iter(result)
+        while True:
+            # The run method executes while the iterator is advanced, so mark the run as in progress
+            run_in_progress = self._run_in_progress
+            self._run_in_progress = True
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                self._run_in_progress = run_in_progress
+
+            if isinstance(item, RunResponse):
+                # Update the run_id, session_id and workflow_id of the RunResponse
+                item.run_id = self.run_id
+                item.session_id = self.session_id
+                item.workflow_id = self.workflow_id
+
+                # Collect the content from the result
+                if item.content is not None and isinstance(item.content, str):
+                    content_chunks.append(item.content)
+            else:
+                logger.warning("Workflow.run() should only yield RunResponse objects, got: %s", type(item))
+            yield item
+
+        # Update the run_response with the content from the result
+        self.run_response.content = "".join(content_chunks)
+        # Add the run to the memory
+        self.memory.add_run(WorkflowRun(input=self.run_input, response=self.run_response))
+        # Write this run to the database
+        self.write_run_to_storage()
+        logger.debug("*********** Workflow Run End: %s ***********", self.run_id)
+
+    def _handle_single(self, result: RunResponse) -> RunResponse:
+        """Save the RunResponse returned by the run method"""
+
+        # Update the result with the run_id, session_id and workflow_id of the workflow run
+        result.run_id = self.run_id
+        result.session_id = self.session_id
+        result.workflow_id = self.workflow_id
+
+        # Update the run_response with the content from the result
+        if result.content is not None and isinstance(result.content, str):
+            self.run_response.content = result.content
+
+        # Add the run to the memory
+        self.memory.add_run(WorkflowRun(input=self.run_input, response=self.run_response))
+        # Write this run to the database
+        self.write_run_to_storage()
+        logger.debug("*********** Workflow Run End: %s ***********", self.run_id)
+        return result
+
     def __init__(self, **data):
         super().__init__(**data)
         self.name = self.name or self.__class__.__name__
-        # Check if 'run' is provided by the subclass
-        if self.__class__.run is not Workflow.run:
-            # Store the original run method bound to the instance
-            self._subclass_run = self.__class__.run.__get__(self)
-            # Get the parameters of the run method
-            sig = inspect.signature(self.__class__.run)
-            # Convert parameters to a serializable format
-            self._run_parameters = {
-                name: {
-                    "name": name,
-                    "default": param.default if param.default is not inspect.Parameter.empty else None,
-                    "annotation": (
-                        param.annotation.__name__
-                        if hasattr(param.annotation, "__name__")
-                        else (
-                            str(param.annotation).replace("typing.Optional[", "").replace("]", "")
-                            if "typing.Optional" in str(param.annotation)
-                            else str(param.annotation)
-                        )
-                    )
-                    if param.annotation is not inspect.Parameter.empty
-                    else None,
-                    "required": param.default is inspect.Parameter.empty,
-                }
-                for name, param in sig.parameters.items()
-                if name != "self"
-            }
-            # Determine the return type of the run method
-            return_annotation = sig.return_annotation
-            self._run_return_type = (
-                return_annotation.__name__
-                if return_annotation is not inspect.Signature.empty and hasattr(return_annotation, "__name__")
-                else str(return_annotation)
-                if return_annotation is not inspect.Signature.empty
-                else None
-            )
-            # Replace the instance's run method with run_workflow
-            object.__setattr__(self, "run", self.run_workflow.__get__(self))
-        else:
-            # This will log an error when called
-            self._subclass_run = self.run
-            self._run_parameters = {}
-            self._run_return_type = None
+
+    @classmethod
+    def __pydantic_init_subclass__(cls, **kwargs: Any) -> None:
+        super().__pydantic_init_subclass__(**kwargs)
+        # Check if 'run' is provided by the subclass, either in its own body or by a base class like a mixin
+        # Subclasses that inherit an already wrapped 'run' inherit the values set for their parent
+        run = cls.run
+        if run is not Workflow.run and not getattr(run, "_is_wrapped_run", False):
+            # Store the original run method, it is bound to the instance on access
+            cls._subclass_run = run
+            # Inspect the run method once per subclass instead of on every instance
+            cls._run_parameters, cls._run_return_type, cls._run_mode = _introspect_run(run)
+            # Replace the class's run method with a wrapper that starts a workflow run
+            cls.run = _wrap_run(run)  # type: ignore
 
     def model_post_init(self, __context: Any) -> None:
         super().model_post_init(__context)
@@ -363,11 +510,12 @@ class Workflow(BaseModel):
                 value.session_id = self.session_id
 
     def log_workflow_session(self):
-        logger.debug(f"*********** Logging WorkflowSession: {self.session_id} ***********")
+        logger.debug("*********** Logging WorkflowSession: %s ***********", self.session_id)
 
     def rename_session(self, session_id: str, name: str):
         if self.storage is None:
             raise ValueError("Storage is not set")
+        self.flush()
         workflow_session = self.storage.read(session_id)
         if workflow_session is None:
             raise Exception(f"WorkflowSession not found: {session_id}")
@@ -376,11 +524,19 @@ class Workflow(BaseModel):
         else:
             workflow_session.session_data = {"session_name": name}
         self.storage.upsert(workflow_session)
+        # Keep the current session in sync with the renamed session
+        if session_id == self.session_id:
+            self.session_name = name
+            self.mark_session_dirty()
 
     def delete_session(self, session_id: str):
         if self.storage is None:
             raise ValueError("Storage is not set")
+        self.flush()
         self.storage.delete_session(session_id)
+        # Forget the deleted session so it is not used for the next run
+        if session_id == self.session_id:
+            self._workflow_session = None
 
     def deep_copy(self, *, update: Optional[Dict[str, Any]] = None) -> "Workflow":
         """Create and return a deep copy of this Workflow, optionally updating fields.
@@ -409,7 +565,7 @@ class Workflow(BaseModel):
         # Create a new Workflow
         new_workflow = self.__class__(**fields_for_new_workflow)
         logger.debug(
-            f"Created new Workflow: workflow_id: {new_workflow.workflow_id} | session_id: {new_workflow.session_id}"
+            "Created new Workflow: workflow_id: %s | session_id: %s", new_workflow.workflow_id, new_workflow.session_id
         )
         return new_workflow
 
@@ -426,11 +582,11 @@ class Workflow(BaseModel):
             try:
                 return deepcopy(field_value)
             except Exception as e:
-                logger.warning(f"Failed to deepcopy field: {field_name} - {e}")
+                logger.warning("Failed to deepcopy field: %s - %s", field_name, e)
                 try:
                     return copy(field_value)
                 except Exception as e:
-                    logger.warning(f"Failed to copy field: {field_name} - {e}")
+                    logger.warning("Failed to copy field: %s - %s", field_name, e)
                     return field_value
 
         # For pydantic models, attempt a deep copy
@@ -438,11 +594,11 @@ class Workflow(BaseModel):
             try:
                 return field_value.model_copy(deep=True)
             except Exception as e:
-                logger.warning(f"Failed to deepcopy field: {field_name} - {e}")
+                logger.warning("Failed to deepcopy field: %s - %s", field_name, e)
                 try:
                     return field_value.model_copy(deep=False)
                 except Exception as e:
-                    logger.warning(f"Failed to copy field: {field_name} - {e}")
+                    logger.warning("Failed to copy field: %s - %s", field_name, e)
                     return field_value
 
         # For other types, return as is
@@ -0,0 +1,382 @@
+import time
+from typing import Dict, Iterator, List, Optional
+
+import pytest
+
+from phi.run.response import RunResponse
+from phi.workflow import Workflow, WorkflowSession, WorkflowStorage
+
+
+class InMemoryWorkflowStorage(WorkflowStorage):
+    """WorkflowStorage that keeps serialized sessions in a dict, like a database would"""
+
+    def __init__(self):
+        self.sessions: Dict[str, str] = {}
+
+    def create(self) -> None:
+        pass
+
+    def read(self, session_id: str, user_id: Optional[str] = None) -> Optional[WorkflowSession]:
+        session_json = self.sessions.get(session_id)
+        return WorkflowSession.model_validate_json(session_json) if session_json is not None else None
+
+    def get_all_session_ids(self, user_id: Optional[str] = None, workflow_id: Optional[str] = None) -> List[str]:
+        return list(self.sessions)
+
+    def get_all_sessions(
+        self, user_id: Optional[str] = None, workflow_id: Optional[str] = None
+    ) -> List[WorkflowSession]:
+        return [WorkflowSession.model_validate_json(s) for s in self.sessions.values()]
+
+    def upsert(self, session: WorkflowSession) -> Optional[WorkflowSession]:
+        self.sessions[session.session_id] = session.model_dump_json()
+        return self.read(session.session_id)
+
+    def delete_session(self, session_id: Optional[str] = None):
+        if session_id is not None:
+            self.sessions.pop(session_id, None)
+
+    def drop(self) -> None:
+        self.sessions.clear()
+
+    def upgrade_schema(self) -> None:
+        pass
+
+
+class RunMixin:
+    def run(self, topic: str) -> RunResponse:
+        return RunResponse(content=topic)
+
+
+class MixinWorkflow(RunMixin, Workflow):
+    pass
+
+
+def test_run_provided_by_mixin_is_wrapped():
+    workflow = MixinWorkflow()
+    response = workflow.run("mixin")
+
+    assert response.content == "mixin"
+    assert workflow.run_id is not None
+    assert response.run_id == workflow.run_id
+    assert len(workflow.memory.runs) == 1
+    assert MixinWorkflow._run_return_type == "RunResponse"
+    assert list(MixinWorkflow._run_parameters) == ["topic"]
+
+
+class StreamWorkflow(Workflow):
+    def run(self, count: int = 2) -> Iterator[RunResponse]:
+        for i in range(count):
+            yield RunResponse(content=str(i))
+
+
+class InheritedStreamWorkflow(StreamWorkflow):
+    pass
+
+
+def test_inherited_run_is_wrapped_once():
+    workflow = InheritedStreamWorkflow()
+    responses = list(workflow.run(count=3))
+
+    assert [r.content for r in responses] == ["0", "1", "2"]
+    assert workflow.run_response.content == "012"
+    assert len(workflow.memory.runs) == 1
+
+
+class BaseAddWorkflow(Workflow):
+    def run(self, x: int) -> RunResponse:
+        return RunResponse(content=f"A{x}")
+
+
+class ChildAddWorkflow(BaseAddWorkflow):
+    def run(self, x: int) -> RunResponse:
+        parent = super().run(x)
+        return RunResponse(content=f"B{parent.content}")
+
+
+def test_subclass_run_can_call_super_run():
+    workflow = ChildAddWorkflow()
+    response = workflow.run(3)
+
+    assert response.content == "BA3"
+    assert response.run_id == workflow.run_id
+    assert len(workflow.memory.runs) == 1
+
+
+class ChildStreamWorkflow(StreamWorkflow):
+    def run(self, count: int = 2) -> Iterator[RunResponse]:
+        yield RunResponse(content="start ")
+        yield from super().run(count)
+
+
+def test_streaming_subclass_run_can_call_super_run():
+    workflow = ChildStreamWorkflow()
+    responses = list(workflow.run(count=2))
+
+    assert [r.content for r in responses] == ["start ", "0", "1"]
+    assert all(r.run_id == workflow.run_id for r in responses)
+    assert workflow.run_response.content == "start 01"
+    assert len(workflow.memory.runs) == 1
+    # The wrapped run method can be called again once the previous run is finished
+    assert [r.content for r in workflow.run(count=1)] == ["start ", "0"]
+    assert len(workflow.memory.runs) == 2
+
+
+class CounterWorkflow(Workflow):
+    def run(self) -> RunResponse:
+        self.session_state["count"] = self.session_state.get("count", 0) + 1
+        return RunResponse(content=str(self.session_state["count"]))
+
+
+def test_rename_session_is_kept_by_the_next_run():
+    storage = InMemoryWorkflowStorage()
+    workflow = CounterWorkflow(storage=storage, session_id="session")
+    workflow.run()
+
+    workflow.rename_session("session", "renamed")
+    workflow.run()
+
+    session = storage.read("session")
+    assert session is not None
+    assert session.session_data is not None
+    assert session.session_data["session_name"] == "renamed"
+    assert session.session_data["session_state"] == {"count": 2}
+
+
+def test_mark_session_dirty_reads_the_session_again():
+    storage = InMemoryWorkflowStorage()
+    workflow = CounterWorkflow(storage=storage, session_id="session")
+    workflow.run()
+
+    # Change the session in storage from outside of the workflow
+    session = storage.read("session")
+    assert session is not None and session.session_data is not None
+    session.session_data["session_state"]["extra"] = True
+    storage.upsert(session)
+
+    workflow.mark_session_dirty()
+    workflow.run()
+
+    assert workflow.session_state == {"count": 2, "extra": True}
+
+
+def test_delete_session_forgets_the_loaded_session():
+    storage = InMemoryWorkflowStorage()
+    workflow = CounterWorkflow(storage=storage, session_id="session")
+    workflow.run()
+
+    workflow.delete_session("session")
+    workflow.run()
+
+    session = storage.read("session")
+    assert session is not None
+    assert session.memory is not None
+    assert len(session.memory["runs"]) == 2
+
+
+class RecursiveWorkflow(Workflow):
+    def run(self, n: int) -> RunResponse:
+        if n > 1:
+            self.run(n - 1)
+        return RunResponse(content=str(n))
+
+
+def test_self_run_during_a_run_starts_a_new_run():
+    workflow = RecursiveWorkflow()
+    response = workflow.run(3)
+
+    assert response.content == "3"
+    # Each self.run() call is recorded as its own run, like calling run() from outside the workflow
+    assert len(workflow.memory.runs) == 3
+
+
+class RecursiveChildWorkflow(ChildAddWorkflow):
+    def run(self, x: int) -> RunResponse:
+        if x > 1:
+            self.run(x - 1)
+        return super().run(x)
+
+
+def test_self_run_and_super_run_in_the_same_run():
+    workflow = RecursiveChildWorkflow()
+    response = workflow.run(2)
+
+    assert response.content == "BA2"
+    # self.run() starts a new run, super().run() does not
+    assert len(workflow.memory.runs) == 2
+
+
+class EarlyExitWorkflow(Workflow):
+    def run(self, exit_early: bool = False) -> RunResponse:
+        if exit_early:
+            return None  # type: ignore
+        return RunResponse(content="done")
+
+
+def test_run_annotated_as_run_response_can_return_none():
+    workflow = EarlyExitWorkflow()
+
+    assert workflow.run(exit_early=True) is None
+    assert len(workflow.memory.runs) == 0
+    assert workflow.run().content == "done"
+    assert len(workflow.memory.runs) == 1
+
+
+class MisannotatedStreamWorkflow(Workflow):
+    def run(self) -> Iterator[RunResponse]:
+        return RunResponse(content="single")  # type: ignore
+
+
+def test_run_annotated_as_iterator_can_return_run_response():
+    workflow = MisannotatedStreamWorkflow()
+    response = workflow.run()
+
+    assert isinstance(response, RunResponse)
+    assert response.content == "single"
+    assert len(workflow.memory.runs) == 1
+
+
+class SlowInMemoryWorkflowStorage(InMemoryWorkflowStorage):
+    """Records the number of runs in each upsert, and fails when fail_upserts is set"""
+
+    def __init__(self, delay: float = 0.05):
+        super().__init__()
+        self.delay = delay
+        self.fail_upserts = False
+        self.upserted_runs: List[int] = []
+
+    def upsert(self, session: WorkflowSession) -> Optional[WorkflowSession]:
+        time.sleep(self.delay)
+        if self.fail_upserts:
+            raise RuntimeError("upsert failed")
+        self.upserted_runs.append(len(session.memory["runs"]) if session.memory else 0)
+        return super().upsert(session)
+
+
+def test_background_writes_are_applied_in_order():
+    storage = SlowInMemoryWorkflowStorage()
+    workflow = CounterWorkflow(storage=storage, session_id="session", background_storage_writes=True)
+    for _ in range(3):
+        workflow.run()
+
+    saved_session = workflow.flush()
+
+    assert storage.upserted_runs == [1, 2, 3]
+    assert saved_session is not None
+    assert saved_session.session_data is not None
+    assert saved_session.session_data["session_state"] == {"count": 3}
+
+
+def test_background_write_is_a_snapshot_of_the_run():
+    storage = SlowInMemoryWorkflowStorage()
+    workflow = CounterWorkflow(storage=storage, session_id="session", background_storage_writes=True)
+    workflow.run()
+    # Change the session_state while the write is still pending
+    workflow.session_state["count"] = 100
+    workflow.flush()
+
+    session = storage.read("session")
+    assert session is not None and session.session_data is not None
+    assert session.session_data["session_state"] == {"count": 1}
+
+
+def test_background_write_errors_are_raised_by_flush():
+    storage = SlowInMemoryWorkflowStorage()
+    storage.fail_upserts = True
+    workflow = CounterWorkflow(storage=storage, session_id="session", background_storage_writes=True)
+    workflow.run()
+
+    with pytest.raises(RuntimeError, match="upsert failed"):
+        workflow.flush()
+    # The failed write is not raised again
+    assert workflow.flush() is None
+
+
+def test_failed_background_write_leaves_the_run_state_unchanged():
+    storage = SlowInMemoryWorkflowStorage()
+    storage.fail_upserts = True
+    workflow = CounterWorkflow(storage=storage, session_id="session", background_storage_writes=True)
+    workflow.run()
+    run_id = workflow.run_id
+    run_input = workflow.run_input
+
+    with pytest.raises(RuntimeError, match="upsert failed"):
+        workflow.run()
+
+    assert workflow.run_id == run_id
+    assert workflow.run_input == run_input
+    assert workflow.run_response.run_id == run_id
+    assert workflow.run_response.content == "1"
+    assert workflow.session_state == {"count": 1}
+
+
+def test_background_writes_fall_back_for_in_memory_sqlite():
+    pytest.importorskip("sqlalchemy")
+    from phi.storage.workflow.sqlite import SqlWorkflowStorage
+
+    storage = SqlWorkflowStorage(table_name="workflow_sessions")
+    assert not storage.supports_background_writes()
+
+    workflow = CounterWorkflow(storage=storage, session_id="session", background_storage_writes=True)
+    workflow.run()
+
+    # The run is written on the calling thread, so it is visible without flush()
+    session = storage.read("session")
+    assert session is not None and session.memory is not None
+    assert len(session.memory["runs"]) == 1
+
+
+def test_background_writes_are_supported_for_sqlite_files(tmp_path):
+    pytest.importorskip("sqlalchemy")
+    from phi.storage.workflow.sqlite import SqlWorkflowStorage
+
+    storage = SqlWorkflowStorage(table_name="workflow_sessions", db_file=str(tmp_path / "workflows.db"))
+    assert storage.supports_background_writes()
+
+    workflow = CounterWorkflow(storage=storage, session_id="session", background_storage_writes=True)
+    workflow.run()
+    workflow.flush()
+
+    session = storage.read("session")
+    assert session is not None and session.memory is not None
+    assert len(session.memory["runs"]) == 1
+
+
+class NextOnly:
+    """Has __next__ but no __iter__, so it is not an iterator"""
+
+    def __next__(self):
+        raise StopIteration
+
+
+class UnannotatedWorkflow(Workflow):
+    def run(self, kind: str):
+        if kind == "single":
+            return RunResponse(content="single")
+        if kind == "iterator":
+            return iter([RunResponse(content="a"), RunResponse(content="b")])
+        return NextOnly()
+
+
+def test_unannotated_run_returning_run_response():
+    workflow = UnannotatedWorkflow()
+    response = workflow.run("single")
+
+    assert isinstance(response, RunResponse)
+    assert response.content == "single"
+    assert len(workflow.memory.runs) == 1
+
+
+def test_unannotated_run_returning_iterator():
+    workflow = UnannotatedWorkflow()
+    responses = list(workflow.run("iterator"))
+
+    assert [r.content for r in responses] == ["a", "b"]
+    assert workflow.run_response.content == "ab"
+
+
+def test_unannotated_run_returning_non_iterator_with_next():
+    workflow = UnannotatedWorkflow()
+
+    assert workflow.run("next_only") is None
+    assert len(workflow.memory.runs) == 0